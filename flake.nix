@@ -19,9 +19,9 @@
 
         propagatedBuildInputs = with pkgs.${system}.python3.pkgs; [
           pyyaml
-          jsonref
           click
           kubernetes
+          orjson
         ];
 
         nativeBuildInputs = with pkgs.${system}.python3.pkgs; [
@@ -33,7 +33,7 @@
           pytest-black
           pytest-isort
           pytest-cov
-          pytest-datafiles
+          pytest-xdist
         ];
 
         dontUsePytestCheck = true;
@@ -1,26 +1,262 @@
 #!/usr/bin/env python3
 
-import json
-import urllib.request
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
-from typing import Dict, Optional, cast
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from urllib.parse import urlparse
 
 import click
-import kubernetes
-import yaml
-from jsonref import JsonRef
 
-from openapi2jsonschema.errors import UnsupportedError
 from openapi2jsonschema.log import debug, error, info
 from openapi2jsonschema.util import (
     additional_properties,
-    allow_null_optional_fields,
-    append_no_duplicates,
     change_dict_values,
-    replace_int_or_string,
+    dumps_json,
+    dumps_one_of_refs,
+    extend_no_duplicates,
+    has_refs,
+    inline_refs,
+    load_json_or_yaml,
+    read_url,
+    transform_properties,
 )
 
+# Kubernetes types in this namespace belong to deprecated APIs
+_K8S_DEPRECATED_PREFIX = "io.k8s.kubernetes.pkg."
+
+# This list of Kubernetes types carry around jsonschema for Kubernetes and don't
+# currently work with openapi2jsonschema
+_K8S_STANDALONE_BLOCKLIST = frozenset(
+    {
+        "jsonschemaprops",
+        "jsonschemapropsorarray",
+        "customresourcevalidation",
+        "customresourcedefinition",
+        "customresourcedefinitionspec",
+        "customresourcedefinitionlist",
+        "jsonschemapropsorstringarray",
+        "jsonschemapropsorbool",
+    }
+)
+
+# Default maximum depth of nested references inlined with --stand-alone
+_MAX_REF_DEPTH = 64
+
+# Specifications with fewer types than this aren't worth the process pool startup
+_PARALLEL_THRESHOLD = 32
+# Number of types sent to a pool worker at once
+_CHUNK_SIZE = 16
+
+# The title of the type for all.json, the file name, the file content and an error
+# message. The title is None for types left out because of the error, and the content
+# is None if the conversion failed.
+_Result = Tuple[Optional[str], Optional[str], Optional[bytes], Optional[str]]
+
+# Documents loaded in a pool worker, shared by all types converted by it
+_worker_documents: Dict[str, Any] = {}
+
+
+def _init_worker(documents: Dict[str, Any]):
+    """
+    Sets up a pool worker with the documents already loaded by the main process
+    """
+    _worker_documents.update(documents)
+
+
+def _is_skipped(
+    title: str,
+    specification: Dict,
+    stand_alone: bool,
+    kubernetes: bool,
+    only_top_level: bool,
+) -> bool:
+    """
+    Returns whether the type isn't converted at all
+    """
+    if not kubernetes:
+        return False
+    properties = specification.get("properties")
+    if (
+        only_top_level
+        and properties
+        and not ("kind" in properties and "apiVersion" in properties)
+    ):
+        return True
+
+    # These APIs are all deprecated
+    if title.startswith(_K8S_DEPRECATED_PREFIX):
+        info(f"{title} not currently supported, due to use of pkg namespace")
+        return True
+
+    kind = title.rsplit(".", 1)[-1]
+    if stand_alone and kind.lower() in _K8S_STANDALONE_BLOCKLIST:
+        info(f"{kind} not currently supported")
+        return True
+    return False
+
+
+def _prepare_schema(
+    specification: Dict,
+    prefix: str,
+    major_version: int,
+    strict: bool,
+    memo: Optional[Dict] = None,
+):
+    """
+    Sets the top level keywords of the JSON Schema of a type and rewrites its references
+    """
+    specification["$schema"] = "http://json-schema.org/schema#"
+    specification.setdefault("type", "object")
+
+    if strict:
+        specification["additionalProperties"] = False
+
+    change_dict_values(specification, prefix, major_version, memo)
+
+
+def _emit_schema(
+    title: str,
+    specification: Dict,
+    base_uri: str,
+    prefix: str,
+    major_version: int,
+    stand_alone: bool,
+    expanded: bool,
+    kubernetes: bool,
+    strict: bool,
+    only_top_level: bool,
+    max_ref_depth: int,
+    prepared: bool = False,
+    memo: Optional[Dict] = None,
+    documents: Optional[Dict] = None,
+) -> Optional[_Result]:
+    """
+    Renders the JSON Schema file for a single type.
+    Returns None if the type is skipped, otherwise a _Result. Errors are returned
+    instead of being logged, because the output of pool workers isn't captured.
+    prepared tells that the specification already went through _prepare_schema.
+    memo is passed to change_dict_values to skip subtrees already rewritten for other types.
+    documents caches the documents loaded to inline references with --stand-alone,
+    by default the cache of the pool worker is used.
+    """
+    if documents is None:
+        documents = _worker_documents
+    if _is_skipped(title, specification, stand_alone, kubernetes, only_top_level):
+        return None
+    properties = specification.get("properties")
+
+    # Only the last three components of the title are ever needed
+    title_splitted = title.rsplit(".", 3 if kubernetes and expanded else 1)
+    kind = title_splitted[-1]
+
+    full_name = kind
+    if kubernetes and expanded:
+        try:
+            group = title_splitted[-3].lower()
+            api_version = title_splitted[-2].lower()
+        except IndexError:
+            return (
+                None,
+                None,
+                None,
+                f"unable to determine group and apiversion from {title}",
+            )
+        full_name = (
+            f"{kind}-{api_version}"
+            if group in ["core", "api"]
+            else f"{kind}-{group}-{api_version}"
+        )
+
+    debug(f"Processing {full_name}")
+    try:
+        if not prepared:
+            _prepare_schema(specification, prefix, major_version, strict, memo)
+
+        # Types without references don't need to be copied, unless the specification
+        # is also one of the documents used to inline references
+        if stand_alone and (prepared or has_refs(specification)):
+            specification = inline_refs(
+                specification, base_uri, documents, max_ref_depth
+            )
+
+        # Without --stand-alone the properties before OpenAPI 3.0 are those of the
+        # definitions, which already went through additional_properties()
+        strict_properties = strict and (stand_alone or major_version >= 3)
+        if properties and (strict_properties or kubernetes):
+            transform_properties(
+                specification["properties"], strict_properties, kubernetes
+            )
+
+        content = dumps_json(specification)
+    except Exception as e:
+        return title, None, None, f"An error occured processing {kind}: {e}"
+
+    return title, f"{full_name}.json", content, None
+
+
+@contextmanager
+def _output_writer(
+    output: Path, as_zip: bool
+) -> Iterator[Callable[[str, bytes], None]]:
+    """
+    Yields a function writing files into the output directory, or into schemas.zip
+    in it with as_zip.
+    Files are opened relative to a descriptor of the directory, so the full output
+    path isn't resolved again for every file.
+    """
+    if as_zip:
+        # The schemas are small and very repetitive, so fast compression is enough
+        with zipfile.ZipFile(
+            output / "schemas.zip", "w", zipfile.ZIP_DEFLATED, compresslevel=1
+        ) as archive:
+            yield archive.writestr
+        return
+
+    if os.open not in os.supports_dir_fd or not hasattr(os, "O_DIRECTORY"):
+        # E.g. on Windows files can only be opened by their full path
+        yield lambda name, content: output.joinpath(name).write_bytes(content)
+        return
+
+    dir_fd = os.open(output, os.O_RDONLY | os.O_DIRECTORY)
+
+    def write(name: str, content: bytes):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        fd = os.open(name, flags, 0o666, dir_fd=dir_fd)
+        with os.fdopen(fd, "wb", buffering=65536) as f:
+            f.write(content)
+
+    try:
+        yield write
+    finally:
+        os.close(dir_fd)
+
+
+def _write_schemas(
+    results: Iterable[Optional[_Result]],
+    write: Callable[[str, bytes], None],
+) -> List[str]:
+    """
+    Writes the results of _emit_schema as they come in, logging their errors.
+    Returns the titles of the types to list in all.json.
+    """
+    types = []
+    for result in results:
+        if result is None:
+            continue
+        title, file_name, content, message = result
+        if message is not None:
+            error(message)
+        if title is not None:
+            types.append(title)
+        if content is not None:
+            debug(f"Generating {file_name}")
+            write(file_name, content)
+    return types
+
 
 def process(
     data,
@@ -31,6 +267,8 @@ def process(
     kubernetes: bool,
     strict: bool,
     only_top_level: bool,
+    max_ref_depth: int = _MAX_REF_DEPTH,
+    as_zip: bool = False,
 ):
     """
     Converts a valid OpenAPI specification into a set of JSON Schema files
@@ -40,175 +278,146 @@ def process(
         raise ValueError(
             "cannot convert data to JSON because we could not find 'openapi' or 'swagger' keys"
         )
+    # YAML specifications may have a number here, e.g. swagger: 2.0
+    try:
+        major_version = int(str(version).split(".")[0])
+    except ValueError:
+        raise ValueError(f"cannot convert data to JSON with version {version!r}")
 
     output.mkdir(parents=True, exist_ok=True)
 
-    if version < "3":
+    if major_version < 3:
         components = data["definitions"]
     else:
         components = data["components"]["schemas"]
 
-    if version < "3":
-        info("Generating shared definitions")
-        if kubernetes:
-            components["io.k8s.apimachinery.pkg.util.intstr.IntOrString"] = {
-                "description": components[
-                    "io.k8s.apimachinery.pkg.util.intstr.IntOrString"
-                ]["description"],
-                "oneOf": [{"type": "string"}, {"type": "integer"}],
-            }
-            # Although the kubernetes api does not allow `number`  as valid
-            # Quantity type - almost all kubenetes tooling
-            # recognizes it is valid. For this reason, we extend the API definition to
-            # allow `number` values.
-            components["io.k8s.apimachinery.pkg.api.resource.Quantity"] = {
-                "description": components[
-                    "io.k8s.apimachinery.pkg.api.resource.Quantity"
-                ]["description"],
-                "oneOf": [{"type": "string"}, {"type": "number"}],
-            }
-            components["io.k8s.apimachinery.pkg.api.resource.Quantity_v2"] = {
-                "description": components[
-                    "io.k8s.apimachinery.pkg.api.resource.Quantity_v2"
-                ]["description"],
-                "oneOf": [{"type": "string"}, {"type": "number"}],
-            }
-
-            # For Kubernetes, populate `apiVersion` and `kind` properties from `x-kubernetes-group-version-kind`
-            for type_name, type_def in components.items():
-                try:
-                    type_properties = type_def["properties"]
-                except KeyError:
-                    error(f"{type_name} has no properties")
-                    continue
-
-                for kube_ext in type_def.get("x-kubernetes-group-version-kind", []):
+    with _output_writer(output, as_zip) as write:
+        if major_version < 3:
+            info("Generating shared definitions")
+            if kubernetes:
+                components["io.k8s.apimachinery.pkg.util.intstr.IntOrString"] = {
+                    "description": components[
+                        "io.k8s.apimachinery.pkg.util.intstr.IntOrString"
+                    ]["description"],
+                    "oneOf": [{"type": "string"}, {"type": "integer"}],
+                }
+                # Although the kubernetes api does not allow `number`  as valid
+                # Quantity type - almost all kubenetes tooling
+                # recognizes it is valid. For this reason, we extend the API definition to
+                # allow `number` values.
+                components["io.k8s.apimachinery.pkg.api.resource.Quantity"] = {
+                    "description": components[
+                        "io.k8s.apimachinery.pkg.api.resource.Quantity"
+                    ]["description"],
+                    "oneOf": [{"type": "string"}, {"type": "number"}],
+                }
+                components["io.k8s.apimachinery.pkg.api.resource.Quantity_v2"] = {
+                    "description": components[
+                        "io.k8s.apimachinery.pkg.api.resource.Quantity_v2"
+                    ]["description"],
+                    "oneOf": [{"type": "string"}, {"type": "number"}],
+                }
+
+                # For Kubernetes, populate `apiVersion` and `kind` properties from `x-kubernetes-group-version-kind`
+                for type_name, type_def in components.items():
+                    try:
+                        type_properties = type_def["properties"]
+                    except KeyError:
+                        error(f"{type_name} has no properties")
+                        continue
+
+                    kube_exts = type_def.get("x-kubernetes-group-version-kind")
+                    if not kube_exts:
+                        continue
                     if "apiVersion" in type_properties:
-                        api_version = "/".join(
-                            filter(None, [kube_ext["group"], kube_ext["version"]])
-                        )
-                        append_no_duplicates(
+                        extend_no_duplicates(
                             type_properties["apiVersion"],
                             "enum",
-                            api_version,
+                            (
+                                "/".join(filter(None, [ext["group"], ext["version"]]))
+                                for ext in kube_exts
+                            ),
                         )
                     if "kind" in type_properties:
-                        append_no_duplicates(
-                            type_properties["kind"], "enum", kube_ext["kind"]
+                        extend_no_duplicates(
+                            type_properties["kind"],
+                            "enum",
+                            (ext["kind"] for ext in kube_exts),
                         )
-        if strict:
-            components = additional_properties(components)
-        with output.joinpath("_definitions.json").open("w") as definitions_file:
-            json.dump({"definitions": components}, definitions_file, indent=2)
-
-    types = []
-
-    info("Generating individual schemas")
-    for title, specification in components.items():
-        properties = specification.get("properties")
-        if (
-            kubernetes
-            and only_top_level
-            and properties
-            and not ("kind" in properties and "apiVersion" in properties)
-        ):
-            continue
-        title_splitted = title.split(".")
-        kind = title_splitted[-1]
-        full_name = kind
-        if kubernetes and expanded:
-            try:
-                group = title_splitted[-3].lower()
-                api_version = title_splitted[-2].lower()
-            except IndexError:
-                error(f"unable to determine group and apiversion from {title}")
-                continue
-            full_name = (
-                f"{kind}-{api_version}"
-                if group in ["core", "api"]
-                else f"{kind}-{group}-{api_version}"
+            if strict:
+                additional_properties(components)
+            definitions = dumps_json({"definitions": components})
+            write("_definitions.json", definitions)
+
+        info("Generating individual schemas")
+        base_uri = f"{output.as_uri()}/"
+        documents = {}
+        prepared = stand_alone and major_version >= 3
+        if stand_alone and major_version < 3:
+            # References to the shared definitions are resolved without reading
+            # them back from the output directory
+            documents[f"{base_uri}_definitions.json"] = load_json_or_yaml(definitions)
+        elif prepared:
+            # References point to the files of other types, which may not be written
+            # yet, so they are resolved from the prepared schemas instead
+            memo = {}
+            prepared_components = {}
+            for title, specification in components.items():
+                if _is_skipped(
+                    title, specification, stand_alone, kubernetes, only_top_level
+                ):
+                    continue
+                _prepare_schema(specification, prefix, major_version, strict, memo)
+                documents[f"{base_uri}{title}.json"] = specification
+                prepared_components[title] = specification
+            # Skipped types don't have a file to reference either
+            components = prepared_components
+        emit_schema = partial(
+            _emit_schema,
+            base_uri=base_uri,
+            prefix=prefix,
+            major_version=major_version,
+            stand_alone=stand_alone,
+            expanded=expanded,
+            kubernetes=kubernetes,
+            strict=strict,
+            only_top_level=only_top_level,
+            max_ref_depth=max_ref_depth,
+            prepared=prepared,
+            memo={},
+        )
+        if len(components) < _PARALLEL_THRESHOLD:
+            results = map(
+                partial(emit_schema, documents=documents),
+                components.keys(),
+                components.values(),
             )
-
-        specification["$schema"] = "http://json-schema.org/schema#"
-        specification.setdefault("type", "object")
-
-        if strict:
-            specification["additionalProperties"] = False
-
-        types.append(title)
-
-        try:
-            debug(f"Processing {full_name}")
-
-            # These APIs are all deprecated
-            if (
-                kubernetes
-                and title_splitted[3] == "pkg"
-                and title_splitted[2] == "kubernetes"
-            ):
-                raise UnsupportedError(
-                    f"{title} not currently supported, due to use of pkg namespace"
+            types = _write_schemas(results, write)
+        else:
+            # The loaded documents are passed once per worker instead of once per chunk
+            with ProcessPoolExecutor(
+                initializer=_init_worker, initargs=(documents,)
+            ) as executor:
+                # Each chunk is sent to a worker with its own copy of the memo,
+                # which is then shared by all types in the chunk
+                results = executor.map(
+                    emit_schema,
+                    components.keys(),
+                    components.values(),
+                    chunksize=_CHUNK_SIZE,
                 )
+                types = _write_schemas(results, write)
 
-            # This list of Kubernetes types carry around jsonschema for Kubernetes and don't
-            # currently work with openapi2jsonschema
-            if (
-                kubernetes
-                and stand_alone
-                and kind.lower()
-                in [
-                    "jsonschemaprops",
-                    "jsonschemapropsorarray",
-                    "customresourcevalidation",
-                    "customresourcedefinition",
-                    "customresourcedefinitionspec",
-                    "customresourcedefinitionlist",
-                    "customresourcedefinitionspec",
-                    "jsonschemapropsorstringarray",
-                    "jsonschemapropsorbool",
-                ]
-            ):
-                raise UnsupportedError(f"{kind} not currently supported")
-
-            specification = change_dict_values(specification, prefix, version)
-
-            if stand_alone:
-                base = f"{output.as_uri()}/"
-                specification = JsonRef.replace_refs(specification, base_uri=base)
-                # Make type checker happy, cast to unknown dict
-                specification = cast(Dict, specification)
-
-            if properties:
-                properties = specification["properties"]
-                if strict:
-                    properties = additional_properties(properties)
-
-                if kubernetes:
-                    properties = replace_int_or_string(properties)
-                    properties = allow_null_optional_fields(properties)
-                specification["properties"] = properties
-
-            debug(f"Generating {full_name}.json")
-            with output.joinpath(f"{full_name}.json").open("w") as schema_file:
-                json.dump(specification, schema_file, indent=2)
-        except Exception as e:
-            error(f"An error occured processing {kind}: {e}")
-
-    info("Generating schema for all types")
-    contents = {"oneOf": []}
-    for title in types:
-        if version < "3":
-            contents["oneOf"].append({"$ref": f"{prefix}#/definitions/{title}"})
+        info("Generating schema for all types")
+        if major_version < 3:
+            refs = (f"{prefix}#/definitions/{title}" for title in types)
         else:
-            contents["oneOf"].append(
-                {"$ref": title.replace("#/components/schemas/", "") + ".json"}
-            )
-    with output.joinpath("all.json").open("w") as all_file:
-        json.dump(contents, all_file, indent=2)
+            refs = (f"{title}.json" for title in types)
+        write("all.json", dumps_one_of_refs(refs))
 
 
-@click.command()
-@click.option(
+# Options shared by all commands
+_output_option = click.option(
     "-o",
     "--output",
     type=click.Path(file_okay=False, writable=True, resolve_path=True, path_type=Path),
@@ -216,31 +425,63 @@ def process(
     metavar="PATH",
     help="Directory to store schema files",
 )
+_stand_alone_option = click.option(
+    "--stand-alone", is_flag=True, help="Whether or not to de-reference JSON schemas"
+)
+_strict_option = click.option(
+    "--strict",
+    is_flag=True,
+    help="Prohibits properties not in the schema (additionalProperties: false)",
+)
+_only_top_level_option = click.option(
+    "--only-top-level",
+    is_flag=True,
+    help="Output schemas only with a 'kind' and 'apiVersion' properties (only for kubernetes)",
+)
+_max_ref_depth_option = click.option(
+    "--max-ref-depth",
+    type=click.IntRange(min=1),
+    default=_MAX_REF_DEPTH,
+    show_default=True,
+    metavar="DEPTH",
+    help="Maximum depth of nested references to de-reference with --stand-alone",
+)
+_zip_option = click.option(
+    "--zip",
+    "as_zip",
+    is_flag=True,
+    help="Write the schema files into schemas.zip in the output directory",
+)
+
+
+def _load_schema(url: str):
+    """
+    Downloads and parses the OpenAPI specification at the given URL
+    """
+    raw = read_url(url)
+    info("Parsing schema")
+    return load_json_or_yaml(raw)
+
+
+@click.command()
+@_output_option
 @click.option(
     "-p",
     "--prefix",
     default="_definitions.json",
     help="Prefix for JSON references (only for OpenAPI versions before 3.0)",
 )
-@click.option(
-    "--stand-alone", is_flag=True, help="Whether or not to de-reference JSON schemas"
-)
+@_stand_alone_option
 @click.option(
     "--expanded", is_flag=True, help="Expand Kubernetes schemas by API version"
 )
 @click.option(
     "--kubernetes", is_flag=True, help="Enable Kubernetes specific processors"
 )
-@click.option(
-    "--strict",
-    is_flag=True,
-    help="Prohibits properties not in the schema (additionalProperties: false)",
-)
-@click.option(
-    "--only-top-level",
-    is_flag=True,
-    help="Output schemas only with a 'kind' and 'apiVersion' properties (only for kubernetes)",
-)
+@_strict_option
+@_only_top_level_option
+@_max_ref_depth_option
+@_zip_option
 @click.argument("schema", metavar="SCHEMA_URL")
 def default(
     output: Path,
@@ -251,6 +492,8 @@ def default(
     strict: bool,
     schema: str,
     only_top_level: bool,
+    max_ref_depth: int,
+    as_zip: bool,
 ):
     """
     Converts a valid OpenAPI specification into a set of JSON Schema files
@@ -258,16 +501,23 @@ def default(
     info("Downloading schema")
     if not urlparse(schema).scheme or Path(schema).is_file():
         schema = Path(schema).resolve().as_uri()
-    req = urllib.request.Request(schema)
-    response = urllib.request.urlopen(req)
-
-    info("Parsing schema")
-    # Note that JSON is valid YAML, so we can use the YAML parser whether
-    # the schema is stored in JSON or YAML
-    data = yaml.load(response.read(), Loader=yaml.SafeLoader)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        loading = executor.submit(_load_schema, schema)
+        # Set up the output directory while the schema is being loaded
+        output.mkdir(parents=True, exist_ok=True)
+        data = loading.result()
 
     process(
-        data, output, prefix, stand_alone, expanded, kubernetes, strict, only_top_level
+        data,
+        output,
+        prefix,
+        stand_alone,
+        expanded,
+        kubernetes,
+        strict,
+        only_top_level,
+        max_ref_depth,
+        as_zip,
     )
 
 
@@ -281,34 +531,19 @@ def default(
     help="If set, the server's certificate will not be checked for validity."
     " This will make your HTTPS connections insecure",
 )
-@click.option(
-    "-o",
-    "--output",
-    type=click.Path(file_okay=False, writable=True, resolve_path=True, path_type=Path),
-    default="schemas",
-    metavar="PATH",
-    help="Directory to store schema files",
-)
+@_output_option
 @click.option(
     "-p",
     "--prefix",
     default="_definitions.json",
     help="Prefix for JSON references",
 )
-@click.option(
-    "--stand-alone", is_flag=True, help="Whether or not to de-reference JSON schemas"
-)
+@_stand_alone_option
 @click.option("--expanded", is_flag=True, help="Expand schemas by API version")
-@click.option(
-    "--strict",
-    is_flag=True,
-    help="Prohibits properties not in the schema (additionalProperties: false)",
-)
-@click.option(
-    "--only-top-level",
-    is_flag=True,
-    help="Output schemas only with a 'kind' and 'apiVersion' properties (only for kubernetes)",
-)
+@_strict_option
+@_only_top_level_option
+@_max_ref_depth_option
+@_zip_option
 def kube(
     kubeconfig: Optional[str],
     context: Optional[str],
@@ -319,10 +554,15 @@ def kube(
     expanded: bool,
     strict: bool,
     only_top_level: bool,
+    max_ref_depth: int,
+    as_zip: bool,
 ):
     """
     Loads an OpenAPI specification from Kubernetes and converts it into a set of JSON Schema files
     """
+    # The Kubernetes client is slow to import, so only load it when it's needed
+    import kubernetes
+
     info("Reading kubeconfig")
     configuration = kubernetes.client.Configuration()
     kubernetes.config.load_kube_config(
@@ -340,7 +580,18 @@ def kube(
             auth_settings=["BearerToken"],
             response_type=object,
         )
-    process(data, output, prefix, stand_alone, expanded, True, strict, only_top_level)
+    process(
+        data,
+        output,
+        prefix,
+        stand_alone,
+        expanded,
+        True,
+        strict,
+        only_top_level,
+        max_ref_depth,
+        as_zip,
+    )
 
 
 if __name__ == "__main__":
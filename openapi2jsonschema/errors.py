@@ -1,2 +0,0 @@
-class UnsupportedError(Exception):
-    pass
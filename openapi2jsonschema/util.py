@@ -1,106 +1,249 @@
+import gzip
+import json
+import re
+import urllib.request
+import zlib
+from urllib.parse import unquote, urldefrag, urljoin
+
+import yaml
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeLoader
+
+# JSON documents start with an object or an array, possibly after whitespace
+_JSON_START = re.compile(rb"\s*[{[]")
+
+
 def additional_properties(data):
     "This recreates the behaviour of kubectl at https://github.com/kubernetes/kubernetes/blob/225b9119d6a8f03fcbe3cc3d590c261965d928d0/pkg/kubectl/validation/schema.go#L312"
-    new = {}
-    try:
-        for k, v in data.items():
-            new_v = v
-            if isinstance(v, dict):
-                if "properties" in v:
-                    v.setdefault("additionalProperties", False)
-                new_v = additional_properties(v)
-            else:
-                new_v = v
-            new[k] = new_v
-        return new
-    except AttributeError:
-        return data
-
-
-def replace_int_or_string(data):
-    new = {}
-    try:
-        for k, v in data.items():
-            new_v = v
-            if isinstance(v, dict):
-                if v.get("format") == "int-or-string":
-                    new_v = {"oneOf": [{"type": "string"}, {"type": "integer"}]}
-                else:
-                    new_v = replace_int_or_string(v)
-            elif isinstance(v, list):
-                new_v = list()
-                for x in v:
-                    new_v.append(replace_int_or_string(x))
-            else:
-                new_v = v
-            new[k] = new_v
-        return new
-    except AttributeError:
-        return data
-
-
-def allow_null_optional_fields(data, parent=None, grand_parent=None, key=None):
-    new = {}
-    try:
-        for k, v in data.items():
-            new_v = v
-            if isinstance(v, dict):
-                new_v = allow_null_optional_fields(v, data, parent, k)
-            elif isinstance(v, list):
-                new_v = list()
-                for x in v:
-                    new_v.append(allow_null_optional_fields(x, v, parent, k))
-            elif isinstance(v, str):
-                is_non_null_type = k == "type" and v != "null"
-                has_required_fields = grand_parent and "required" in grand_parent
-                is_required_field = (
-                    has_required_fields and key in grand_parent["required"]
-                )
-                if is_non_null_type and not is_required_field:
-                    new_v = [v, "null"]
-            new[k] = new_v
-        return new
-    except AttributeError:
-        return data
-
-
-def change_dict_values(d, prefix, version):
-    new = {}
-    try:
-        is_nullable = False
-        for k, v in d.items():
-            if k == "nullable":
-                is_nullable = True
-            new_v = v
-            if isinstance(v, dict):
-                new_v = change_dict_values(v, prefix, version)
-            elif isinstance(v, list):
-                new_v = list()
+    for v in data.values():
+        if isinstance(v, dict):
+            if "properties" in v:
+                v.setdefault("additionalProperties", False)
+            additional_properties(v)
+
+
+def transform_properties(data, strict, kubernetes):
+    """
+    Applies the transformations for schema properties in a single pass over data:
+    - strict: the same as additional_properties
+    - kubernetes: replaces int-or-string formats with a oneOf, and allows null values
+      for fields that aren't required
+    """
+    _transform_properties(data, strict, kubernetes, None, None, None)
+
+
+def _transform_properties(data, strict, kubernetes, parent, grand_parent, key):
+    for k, v in data.items():
+        if isinstance(v, dict):
+            if kubernetes and v.get("format") == "int-or-string":
+                v = data[k] = {"oneOf": [{"type": "string"}, {"type": "integer"}]}
+            elif strict and "properties" in v:
+                v.setdefault("additionalProperties", False)
+            _transform_properties(v, strict, kubernetes, data, parent, k)
+        elif isinstance(v, list):
+            if kubernetes:
                 for x in v:
-                    new_v.append(change_dict_values(x, prefix, version))
-            elif isinstance(v, str):
-                if k == "$ref":
-                    if version < "3":
-                        new_v = f"{prefix}{v}"
-                    else:
-                        new_v = v.replace("#/components/schemas/", "") + ".json"
+                    if isinstance(x, dict):
+                        # additionalProperties are never set inside of arrays
+                        _transform_properties(x, False, kubernetes, v, parent, k)
+        elif kubernetes and k == "type" and isinstance(v, str) and v != "null":
+            has_required_fields = grand_parent and "required" in grand_parent
+            is_required_field = has_required_fields and key in grand_parent["required"]
+            if not is_required_field:
+                data[k] = [v, "null"]
+
+
+def change_dict_values(d, prefix, major_version, memo=None):
+    """
+    Rewrites $ref values in place to point at the generated files.
+    Visited subtrees are recorded by identity in memo, so a subtree shared between
+    several places (e.g. through YAML aliases) is only rewritten once.
+    """
+    if memo is None:
+        memo = {}
+    node_id = id(d)
+    if node_id in memo:
+        return
+    # Keep a reference, so the id can't be reused by another object
+    memo[node_id] = d
+    is_nullable = False
+    for k, v in d.items():
+        if k == "nullable":
+            is_nullable = True
+        if isinstance(v, dict):
+            change_dict_values(v, prefix, major_version, memo)
+        elif isinstance(v, list):
+            for x in v:
+                if isinstance(x, dict):
+                    change_dict_values(x, prefix, major_version, memo)
+        elif k == "$ref" and isinstance(v, str):
+            if major_version < 3:
+                d[k] = f"{prefix}{v}"
             else:
-                new_v = v
-            new[k] = new_v
-        if is_nullable and "type" in new:
-            if not isinstance(new["type"], list):
-                new["type"] = [new["type"]]
-            new["type"].append("null")
-        return new
-    except AttributeError:
-        return d
+                d[k] = v.replace("#/components/schemas/", "") + ".json"
+    if is_nullable and "type" in d:
+        if not isinstance(d["type"], list):
+            d["type"] = [d["type"]]
+        d["type"].append("null")
 
 
-def append_no_duplicates(obj, key, value):
+def extend_no_duplicates(obj, key, values):
     """
     Given a dictionary, lookup the given key, if it doesn't exist create a new array.
-    Then check if the given value already exists in the array, if it doesn't add it.
+    Then add the given values that aren't in the array yet, keeping their order.
+    """
+    # Dictionary keys give constant time membership tests and keep insertion order
+    obj[key] = list(dict.fromkeys([*obj.get(key, []), *values]))
+
+
+def dumps_json(obj):
+    """
+    Serializes obj to indented JSON bytes.
+    Uses orjson when it is installed, otherwise falls back to the standard json module.
+    The standard json module is also used for what orjson can't serialize, e.g.
+    integers wider than 64 bits.
     """
-    if key not in obj:
-        obj[key] = []
-    if value not in obj[key]:
-        obj[key].append(value)
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+            )
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj, indent=2).encode()
+
+
+def dumps_one_of_refs(refs):
+    """
+    Serializes {"oneOf": [{"$ref": ref}, ...]} exactly like dumps_json does.
+    The JSON is written out directly instead of building a dictionary per reference.
+    """
+    items = b",\n".join(
+        b'    {\n      "$ref": ' + dumps_json(ref) + b"\n    }" for ref in refs
+    )
+    if not items:
+        return b'{\n  "oneOf": []\n}'
+    return b'{\n  "oneOf": [\n' + items + b"\n  ]\n}"
+
+
+def read_url(url):
+    """
+    Downloads the content at the given URL, decompressing it if needed
+    """
+    # Specifications compress very well, so let servers send them compressed
+    req = urllib.request.Request(url, headers={"Accept-Encoding": "gzip, deflate"})
+    with urllib.request.urlopen(req) as response:
+        raw = response.read()
+        encoding = response.headers.get("Content-Encoding")
+    if encoding == "gzip":
+        return gzip.decompress(raw)
+    if encoding == "deflate":
+        try:
+            return zlib.decompress(raw)
+        except zlib.error:
+            # Some servers send raw deflate data without the zlib wrapper
+            return zlib.decompress(raw, -zlib.MAX_WBITS)
+    return raw
+
+
+def load_json_or_yaml(raw):
+    """
+    Parses a JSON or YAML document given as bytes.
+    Documents looking like JSON are parsed by a JSON parser, because it's much
+    faster than a YAML one. Everything else goes straight to the YAML parser.
+    orjson isn't used here, because it turns integers wider than 64 bits into floats.
+    """
+    if _JSON_START.match(raw):
+        try:
+            return json.loads(raw)
+        except ValueError:
+            # YAML flow mappings and sequences start the same way as JSON
+            pass
+    return yaml.load(raw, Loader=SafeLoader)
+
+
+def has_refs(data):
+    """
+    Returns whether data contains any $ref, stopping at the first one found
+    """
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if isinstance(node.get("$ref"), str):
+                return True
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return False
+
+
+def inline_refs(data, base_uri, documents, max_depth=None):
+    """
+    Returns a copy of data with every $ref replaced by a copy of its target.
+    Referenced documents are loaded once and kept in documents, keyed by URI,
+    so they are shared between calls using the same dictionary.
+    Circular references and references nested deeper than max_depth raise ValueError.
+    """
+    return _inline_refs(data, base_uri, documents, max_depth, set())
+
+
+def _inline_refs(data, base_uri, documents, max_depth, resolving):
+    if isinstance(data, dict):
+        ref = data.get("$ref")
+        if not isinstance(ref, str):
+            return {
+                k: _inline_refs(v, base_uri, documents, max_depth, resolving)
+                for k, v in data.items()
+            }
+        uri = urljoin(base_uri, ref)
+        if uri in resolving:
+            raise ValueError(f"Circular reference: {uri}")
+        # The references being resolved are the chain of references leading here
+        if max_depth is not None and len(resolving) >= max_depth:
+            raise ValueError(f"References nested deeper than {max_depth}: {uri}")
+        document_uri, pointer = urldefrag(uri)
+        try:
+            document = documents[document_uri]
+        except KeyError:
+            document = load_json_or_yaml(read_url(document_uri))
+            documents[document_uri] = document
+        resolving.add(uri)
+        target = _inline_refs(
+            _resolve_pointer(document, pointer),
+            document_uri,
+            documents,
+            max_depth,
+            resolving,
+        )
+        resolving.remove(uri)
+        return target
+    if isinstance(data, list):
+        return [
+            _inline_refs(x, base_uri, documents, max_depth, resolving) for x in data
+        ]
+    return data
+
+
+def _resolve_pointer(document, pointer):
+    parts = unquote(pointer.lstrip("/")).split("/") if pointer else []
+    for part in parts:
+        part = part.replace("~1", "/").replace("~0", "~")
+        if isinstance(document, list):
+            try:
+                part = int(part)
+            except ValueError:
+                pass
+        try:
+            document = document[part]
+        except (TypeError, LookupError):
+            raise ValueError(f"Unresolvable JSON pointer: {pointer!r}")
+    return document
@@ -15,10 +15,10 @@ setup(
     install_requires=[
         "click >= 7.0",
         "PyYAML >= 5.1",
-        "jsonref >= 0.2.0",
         "kubernetes >= 20.0",
+        "orjson >= 3.0",
     ],
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     entry_points={
         "console_scripts": [
             "openapi2jsonschema = openapi2jsonschema.command:default",
@@ -1,19 +1,234 @@
+import json
 import os
+import zipfile
 
 import pytest
 from click.testing import CliRunner
 
-from openapi2jsonschema.command import default
+from openapi2jsonschema import command
+from openapi2jsonschema.command import _PARALLEL_THRESHOLD, default, process
 
 FIXTURE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../fixtures")
 
 
-@pytest.mark.datafiles(os.path.join(FIXTURE_DIR, "petstore.yaml"))
-def test_command(datafiles):
+@pytest.mark.parametrize("spec", sorted(os.listdir(FIXTURE_DIR)))
+def test_command(spec, tmp_path):
     runner = CliRunner()
-    for spec in os.listdir(datafiles):
-        result = runner.invoke(default, ["file://%s" % os.path.join(datafiles, spec)])
-        assert result.exit_code == 0
+    output = tmp_path / "schemas"
+    url = "file://%s" % os.path.join(FIXTURE_DIR, spec)
+    result = runner.invoke(default, ["-o", str(output), url])
+    assert result.exit_code == 0
+    assert "An error occured" not in result.output
+    assert (output / "all.json").is_file()
+
+
+@pytest.mark.parametrize(
+    "option, titles",
+    [
+        (
+            None,
+            [
+                "io.k8s.apimachinery.pkg.apis.meta.v1.ObjectMeta",
+                "io.k8s.api.core.v1.ConfigMap",
+                "io.k8s.api.apps.v1.Deployment",
+                "io.k8s.apiextensions-apiserver.pkg.apis.apiextensions.v1.CustomResourceDefinition",
+            ],
+        ),
+        (
+            "--stand-alone",
+            [
+                "io.k8s.apimachinery.pkg.apis.meta.v1.ObjectMeta",
+                "io.k8s.api.core.v1.ConfigMap",
+                "io.k8s.api.apps.v1.Deployment",
+            ],
+        ),
+        (
+            "--only-top-level",
+            [
+                "io.k8s.api.core.v1.ConfigMap",
+                "io.k8s.api.apps.v1.Deployment",
+                "io.k8s.apiextensions-apiserver.pkg.apis.apiextensions.v1.CustomResourceDefinition",
+            ],
+        ),
+    ],
+)
+def test_command_kubernetes(option, titles, tmp_path):
+    spec = os.path.join(FIXTURE_DIR, "kubernetes.yaml")
+    output = tmp_path / "schemas"
+    args = ["-o", str(output), "--kubernetes", "--expanded", spec]
+    if option:
+        args.insert(0, option)
+    result = CliRunner().invoke(default, args)
+    assert result.exit_code == 0
+    assert "io.k8s.kubernetes.pkg.api.v1.ConfigMap not currently supported" in (
+        result.output
+    )
+
+    # Types without properties are never left out
+    titles = [
+        "io.k8s.apimachinery.pkg.util.intstr.IntOrString",
+        "io.k8s.apimachinery.pkg.api.resource.Quantity",
+        "io.k8s.apimachinery.pkg.api.resource.Quantity_v2",
+        *titles,
+    ]
+    all_types = json.loads((output / "all.json").read_text())
+    assert all_types["oneOf"] == [
+        {"$ref": f"_definitions.json#/definitions/{title}"} for title in titles
+    ]
+    file_names = {
+        "io.k8s.apimachinery.pkg.util.intstr.IntOrString": "IntOrString-util-intstr.json",
+        "io.k8s.apimachinery.pkg.api.resource.Quantity": "Quantity-resource.json",
+        "io.k8s.apimachinery.pkg.api.resource.Quantity_v2": "Quantity_v2-resource.json",
+        "io.k8s.apimachinery.pkg.apis.meta.v1.ObjectMeta": "ObjectMeta-meta-v1.json",
+        "io.k8s.api.core.v1.ConfigMap": "ConfigMap-v1.json",
+        "io.k8s.api.apps.v1.Deployment": "Deployment-apps-v1.json",
+        "io.k8s.apiextensions-apiserver.pkg.apis.apiextensions.v1.CustomResourceDefinition": "CustomResourceDefinition-apiextensions-v1.json",
+    }
+    assert set(os.listdir(output)) == {
+        "all.json",
+        "_definitions.json",
+        *(file_names[title] for title in titles),
+    }
+
+    # The enums are merged with x-kubernetes-group-version-kind
+    properties = json.loads((output / "Deployment-apps-v1.json").read_text())[
+        "properties"
+    ]
+    assert properties["apiVersion"]["enum"] == ["apps/v1", "apps/v1beta2"]
+    assert properties["kind"]["enum"] == ["Deployment"]
+    properties = json.loads((output / "ConfigMap-v1.json").read_text())["properties"]
+    assert properties["apiVersion"]["enum"] == ["v1"]
+    assert properties["kind"]["enum"] == ["ConfigMap"]
+
+
+def _chained_spec(major_version, count):
+    """
+    Returns a specification, where each type references the previous one
+    """
+    ref_prefix = "#/definitions/" if major_version < 3 else "#/components/schemas/"
+    schemas = {"S0": {"type": "object", "properties": {"a": {"type": "string"}}}}
+    for i in range(1, count):
+        schemas[f"S{i}"] = {
+            "type": "object",
+            "properties": {"previous": {"$ref": f"{ref_prefix}S{i - 1}"}},
+        }
+    if major_version < 3:
+        return {"swagger": "2.0", "info": {}, "paths": {}, "definitions": schemas}
+    return {
+        "openapi": "3.0.0",
+        "info": {},
+        "paths": {},
+        "components": {"schemas": schemas},
+    }
+
+
+@pytest.mark.parametrize("major_version", [2, 3])
+@pytest.mark.parametrize("stand_alone", [False, True])
+def test_command_parallel(major_version, stand_alone, tmp_path):
+    # Enough types for the conversion to run in the process pool
+    count = _PARALLEL_THRESHOLD + 8
+    spec = tmp_path / "spec.json"
+    spec.write_text(json.dumps(_chained_spec(major_version, count)))
+    output = tmp_path / "schemas"
+    args = ["-o", str(output), str(spec)]
+    if stand_alone:
+        args.insert(0, "--stand-alone")
+    result = CliRunner().invoke(default, args)
+    assert result.exit_code == 0
+    assert "An error occured" not in result.output
+    expected_files = {f"S{i}.json" for i in range(count)} | {"all.json"}
+    if major_version < 3:
+        expected_files.add("_definitions.json")
+    assert set(os.listdir(output)) == expected_files
+    all_types = json.loads((output / "all.json").read_text())
+    assert len(all_types["oneOf"]) == count
+    schema = json.loads((output / "S1.json").read_text())
+    previous = schema["properties"]["previous"]
+    if stand_alone:
+        # Inlined schemas of OpenAPI 3.0 come from the generated files
+        previous.pop("$schema", None)
+        assert previous == {"type": "object", "properties": {"a": {"type": "string"}}}
+    elif major_version < 3:
+        assert previous == {"$ref": "_definitions.json#/definitions/S0"}
+    else:
+        assert previous == {"$ref": "S0.json"}
+
+
+def test_command_parallel_same_output(tmp_path, monkeypatch):
+    count = _PARALLEL_THRESHOLD + 8
+    data = _chained_spec(3, count)
+    # A type without references, which is transformed and inlined into others
+    data["components"]["schemas"]["S0"]["required"] = ["a"]
+    spec = tmp_path / "spec.json"
+    spec.write_text(json.dumps(data))
+    args = ["--kubernetes", "--strict", "--stand-alone", str(spec)]
+    parallel = tmp_path / "parallel"
+    result = CliRunner().invoke(default, ["-o", str(parallel), *args])
+    assert result.exit_code == 0
+    monkeypatch.setattr(command, "_PARALLEL_THRESHOLD", count + 1)
+    serial = tmp_path / "serial"
+    result = CliRunner().invoke(default, ["-o", str(serial), *args])
+    assert result.exit_code == 0
+    for file_name in os.listdir(parallel):
+        assert (serial / file_name).read_bytes() == (parallel / file_name).read_bytes()
+    schema = json.loads((serial / "S1.json").read_text())
+    assert schema["properties"]["previous"]["properties"]["a"] == {"type": "string"}
+
+
+def test_process_stand_alone_skipped(tmp_path):
+    data = _chained_spec(3, 2)
+    schemas = data["components"]["schemas"]
+    schemas["io.k8s.kubernetes.pkg.Old"] = schemas.pop("S1")
+    process(data, tmp_path, "", True, False, True, False, False)
+    assert set(os.listdir(tmp_path)) == {"all.json", "S0.json"}
+    # Skipped types are left as they are
+    assert schemas["io.k8s.kubernetes.pkg.Old"] == {
+        "type": "object",
+        "properties": {"previous": {"$ref": "#/components/schemas/S0"}},
+    }
+
+
+def test_command_parallel_errors(tmp_path):
+    count = _PARALLEL_THRESHOLD + 8
+    data = _chained_spec(2, count)
+    for title, schema in data["definitions"].items():
+        schema["properties"]["self"] = {"$ref": f"#/definitions/{title}"}
+    spec = tmp_path / "spec.json"
+    spec.write_text(json.dumps(data))
+    output = tmp_path / "schemas"
+    result = CliRunner().invoke(
+        default, ["--stand-alone", "-o", str(output), str(spec)]
+    )
+    assert result.exit_code == 0
+    # Errors of the pool workers are logged by the main process
+    assert result.output.count("An error occured processing") == count
+    assert set(os.listdir(output)) == {"all.json", "_definitions.json"}
+
+
+def test_command_zip(tmp_path):
+    runner = CliRunner()
+    spec = os.path.join(FIXTURE_DIR, "petstore.yaml")
+    output = tmp_path / "schemas"
+    result = runner.invoke(default, ["-o", str(output), "--zip", spec])
+    assert result.exit_code == 0
+    assert os.listdir(output) == ["schemas.zip"]
+    with zipfile.ZipFile(output / "schemas.zip") as archive:
+        assert {"all.json", "Pet.json"} <= set(archive.namelist())
+
+
+def test_command_zip_stand_alone(tmp_path):
+    count = _PARALLEL_THRESHOLD + 8
+    spec = tmp_path / "spec.json"
+    spec.write_text(json.dumps(_chained_spec(3, count)))
+    output = tmp_path / "schemas"
+    args = ["-o", str(output), "--zip", "--stand-alone", str(spec)]
+    result = CliRunner().invoke(default, args)
+    assert result.exit_code == 0
+    assert "An error occured" not in result.output
+    with zipfile.ZipFile(output / "schemas.zip") as archive:
+        assert len(archive.namelist()) == count + 1
+        schema = json.loads(archive.read("S1.json"))
+    assert schema["properties"]["previous"]["properties"] == {"a": {"type": "string"}}
 
 
 def test_version():
@@ -0,0 +1,142 @@
+import gzip
+import io
+import zlib
+from email.message import Message
+
+import pytest
+
+from openapi2jsonschema import util
+from openapi2jsonschema.util import (
+    dumps_json,
+    dumps_one_of_refs,
+    inline_refs,
+    load_json_or_yaml,
+    read_url,
+    transform_properties,
+)
+
+
+def test_transform_properties():
+    properties = {
+        "spec": {
+            "type": "object",
+            "required": ["replicas"],
+            "properties": {
+                "replicas": {"type": "integer"},
+                "paused": {"type": "boolean"},
+                "port": {"type": "string", "format": "int-or-string"},
+            },
+        },
+        "items": {
+            "type": "array",
+            "items": {"oneOf": [{"properties": {"a": {"type": "string"}}}]},
+        },
+    }
+    transform_properties(properties, strict=True, kubernetes=True)
+    assert properties == {
+        "spec": {
+            "type": ["object", "null"],
+            "required": ["replicas"],
+            "properties": {
+                "replicas": {"type": "integer"},
+                "paused": {"type": ["boolean", "null"]},
+                "port": {
+                    "oneOf": [
+                        {"type": ["string", "null"]},
+                        {"type": ["integer", "null"]},
+                    ]
+                },
+            },
+            "additionalProperties": False,
+        },
+        "items": {
+            "type": ["array", "null"],
+            "items": {"oneOf": [{"properties": {"a": {"type": ["string", "null"]}}}]},
+        },
+    }
+
+
+def test_transform_properties_strict_only():
+    properties = {"spec": {"type": "object", "properties": {"a": {"type": "string"}}}}
+    transform_properties(properties, strict=True, kubernetes=False)
+    assert properties == {
+        "spec": {
+            "type": "object",
+            "properties": {"a": {"type": "string"}},
+            "additionalProperties": False,
+        }
+    }
+
+
+@pytest.mark.parametrize("refs", [[], ["Pet.json"], ["Pet.json", "Error.json"]])
+def test_dumps_one_of_refs(refs):
+    expected = dumps_json({"oneOf": [{"$ref": ref} for ref in refs]})
+    assert dumps_one_of_refs(refs) == expected
+
+
+def test_dumps_json_big_integer():
+    assert dumps_json({"maximum": 99999999999999999999}) == (
+        b'{\n  "maximum": 99999999999999999999\n}'
+    )
+
+
+@pytest.mark.parametrize(
+    "raw",
+    [b'{"a": [1, "b"]}', b' \n [{"a": [1, "b"]}]', b"a:\n- 1\n- b\n", b"{a: [1, b]}"],
+)
+def test_load_json_or_yaml(raw):
+    data = load_json_or_yaml(raw)
+    if isinstance(data, list):
+        data = data[0]
+    assert data == {"a": [1, "b"]}
+
+
+def test_load_json_or_yaml_big_integer():
+    data = load_json_or_yaml(b'{"maximum": 99999999999999999999}')
+    assert data == {"maximum": 99999999999999999999}
+
+
+def test_inline_refs_max_depth():
+    documents = {
+        "file:///defs.json": {
+            "a": {"$ref": "#/b"},
+            "b": {"items": {"$ref": "#/c"}},
+            "c": {"type": "string"},
+        }
+    }
+    data = {"properties": {"x": {"$ref": "defs.json#/a"}}}
+    expected = {"properties": {"x": {"items": {"type": "string"}}}}
+    assert inline_refs(data, "file:///", documents, max_depth=3) == expected
+    with pytest.raises(ValueError):
+        inline_refs(data, "file:///", documents, max_depth=2)
+
+
+def _raw_deflate(data):
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+@pytest.mark.parametrize(
+    "encoding, compress",
+    [
+        (None, lambda data: data),
+        ("gzip", gzip.compress),
+        ("deflate", zlib.compress),
+        ("deflate", _raw_deflate),
+    ],
+)
+def test_read_url(encoding, compress, monkeypatch):
+    content = b'{"swagger": "2.0"}'
+    requests = []
+
+    def urlopen(request):
+        requests.append(request)
+        response = io.BytesIO(compress(content))
+        response.headers = Message()
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        return response
+
+    monkeypatch.setattr(util.urllib.request, "urlopen", urlopen)
+    assert read_url("http://example.com/swagger.json") == content
+    assert requests[0].get_header("Accept-encoding") == "gzip, deflate"